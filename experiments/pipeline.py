@@ -48,6 +48,8 @@ class Pipeline:
         self.data_conf = copy.deepcopy(data_conf)
         self.model_conf = copy.deepcopy(model_conf)
         self.model_conf.device = device
+        # data loaders pin memory only for GPU runs
+        self.data_conf.device = device
         self.device = device
         self.TrainerClass = TrainerClass
         self.resume = resume
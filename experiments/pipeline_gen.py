@@ -93,6 +93,13 @@ class GenerativePipeline(Pipeline):
         net = getattr(src.models.gen_models, model_conf.model_name)(
             model_conf=model_conf, data_conf=data_conf
         )
+        if model_conf.get("compile", False):
+            # padding to a constant length keeps batch shapes static, otherwise every
+            # new length recompiles and the cache limit silently falls back to eager
+            assert data_conf.use_constant_pad, "compile requires use_constant_pad"
+            # in-place compile keeps state_dict keys, so checkpoints stay compatible.
+            # model config is fixed for the run, so its branches are specialized away
+            net.compile(mode="reduce-overhead", dynamic=False)
         opt = torch.optim.Adam(
             net.parameters(), model_conf.lr, weight_decay=model_conf.weight_decay
         )
@@ -143,6 +150,7 @@ class GenerativePipeline(Pipeline):
                 device=self.device,
                 model_conf=model_conf,
                 data_conf=data_conf,
+                amp_dtype=model_conf.get("amp_dtype", None),
             )
 
         ### RUN TRAINING ###
@@ -4,16 +4,37 @@ import numpy as np
 import pyarrow.parquet as pq
 
 
-def read_pyarrow_file(path, use_threads=True):
-    p_table = pq.read_table(
-        source=path,
-        use_threads=use_threads,
-    )
+def get_used_columns(conf):
+    """Columns of the raw parquet file that are actually used by the data pipeline."""
+    columns = [
+        "event_time",
+        "feature_arrays",
+        conf.get("col_id", "client_id"),
+        conf.features.target_col,
+        *conf.features.embeddings.keys(),
+        *conf.features.numeric_values.keys(),
+    ]
+    if hasattr(conf, "sber"):
+        columns.append("index")
+    return columns
+
+
+def read_pyarrow_file(path, use_threads=True, columns=None):
+    """Iterate over parquet rows as dicts.
+
+    The file is memory-mapped and decoded batch by batch, so the whole decompressed
+    table is never held in memory at once. If `columns` is passed, only those of them
+    present in the file are read.
+    """
+    p_file = pq.ParquetFile(path, memory_map=True)
 
-    col_indexes = [n for n in p_table.column_names]
+    col_indexes = p_file.schema_arrow.names
+    if columns is not None:
+        columns = set(columns)
+        col_indexes = [n for n in col_indexes if n in columns]
 
     def get_records():
-        for rb in p_table.to_batches():
+        for rb in p_file.iter_batches(columns=col_indexes, use_threads=use_threads):
             col_arrays = [rb.column(i) for i, _ in enumerate(col_indexes)]
             col_arrays = [a.to_numpy(zero_copy_only=False) for a in col_arrays]
             for row in zip(*col_arrays):
@@ -82,7 +103,7 @@ def shuffle_client_list_reproducible(conf, data):
 def prepare_data(conf, supervised, pinch_test=False):
     train_path = conf.train_path
 
-    data = read_pyarrow_file(train_path)
+    data = read_pyarrow_file(train_path, columns=get_used_columns(conf))
     data = data
 
     data = prepare_embeddings(data, conf)
@@ -146,7 +167,7 @@ def split_dataset(data, conf, supervised, pinch_test=False):
 
 
 def prepare_test_data(conf):
-    data = read_pyarrow_file(conf.test_path)
+    data = read_pyarrow_file(conf.test_path, columns=get_used_columns(conf))
     data = data
 
     data = prepare_embeddings(data, conf)
@@ -1,10 +1,12 @@
 import functools
+import math
 import operator
 from collections import defaultdict
-from typing import Dict
+from typing import Dict, Optional, Sequence
 
+import numpy as np
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler
 from torch.nn.utils.rnn import pad_sequence
 
 from ..data_load import split_strategy
@@ -44,20 +46,32 @@ def _create_data_loaders_basic(conf, supervised=True, pinch_test=False):
     train_dataset = DropoutTrxDataset(
         train_dataset, trx_dropout=conf.train.dropout, seq_len=conf.train.max_seq_len
     )
-    if conf.use_constant_pad:
-        collate_func = functools.partial(
-            collate_splitted_rows_constant, max_len=conf.train.max_seq_len
+    collate_func = _make_collate_func(conf, max_len=conf.train.max_seq_len)
+
+    if conf.train.get("bucket_by_length", False):
+        # batches of similar lengths are padded less, unless use_constant_pad.
+        # Lengths are known only for whole records, slicing strategies emit random
+        # length sub-sequences
+        assert (
+            conf.train.split_strategy["split_strategy"] == "NoSplit"
+        ), "bucket_by_length requires NoSplit train split strategy"
+        lengths = [
+            min(len(rec["event_time"]), conf.train.max_seq_len) for rec in train_data
+        ]
+        train_loader = DataLoader(
+            dataset=train_dataset,
+            batch_sampler=LengthBucketBatchSampler(lengths, conf.train.batch_size),
+            collate_fn=collate_func,
+            **_loader_kwargs(conf, "train", persistent=True),
         )
     else:
-        collate_func = collate_splitted_rows
-
-    train_loader = DataLoader(
-        dataset=train_dataset,
-        shuffle=True,
-        collate_fn=collate_func,
-        num_workers=conf.train.num_workers,
-        batch_size=conf.train.batch_size,
-    )
+        train_loader = DataLoader(
+            dataset=train_dataset,
+            shuffle=True,
+            collate_fn=collate_func,
+            batch_size=conf.train.batch_size,
+            **_loader_kwargs(conf, "train", persistent=True),
+        )
 
     valid_dataset = dataset_class(
         valid_data,
@@ -73,8 +87,8 @@ def _create_data_loaders_basic(conf, supervised=True, pinch_test=False):
         dataset=valid_dataset,
         shuffle=False,
         collate_fn=collate_func,
-        num_workers=conf.val.num_workers,
         batch_size=conf.val.batch_size,
+        **_loader_kwargs(conf, "val", persistent=True),
     )
 
     test_dataset = dataset_class(
@@ -91,8 +105,8 @@ def _create_data_loaders_basic(conf, supervised=True, pinch_test=False):
         dataset=test_dataset,
         shuffle=False,
         collate_fn=collate_func,
-        num_workers=conf.test.num_workers,
         batch_size=conf.test.batch_size,
+        **_loader_kwargs(conf, "test"),
     )
 
     if pinch_test:
@@ -125,25 +139,95 @@ def create_test_loader_basic(conf):
         test_dataset, trx_dropout=0.0, seq_len=conf.test.max_seq_len
     )
 
-    if conf.use_constant_pad:
-        collate_func = functools.partial(
-            collate_splitted_rows_constant, max_len=conf.train.max_seq_len
-        )
-    else:
-        collate_func = collate_splitted_rows
+    collate_func = _make_collate_func(conf, max_len=conf.train.max_seq_len)
 
     test_loader = DataLoader(
         dataset=test_dataset,
         shuffle=False,
         collate_fn=collate_func,
-        num_workers=conf.test.num_workers,
         batch_size=conf.test.batch_size,
+        **_loader_kwargs(conf, "test"),
     )
 
     return test_loader
 
 
-def padded_collate(batch):
+def _make_collate_func(conf, max_len):
+    feature_names = dict(
+        numeric_names=list(conf.features.numeric_values.keys()),
+        categorical_names=list(conf.features.embeddings.keys()),
+    )
+    if conf.use_constant_pad:
+        return functools.partial(
+            collate_splitted_rows_constant, max_len=max_len, **feature_names
+        )
+    return functools.partial(collate_splitted_rows, **feature_names)
+
+
+def _loader_kwargs(conf, split, persistent=False):
+    """DataLoader worker settings for the train/val/test part of the data config.
+
+    Workers of persistent loaders (train/val, iterated every epoch) are kept alive
+    between epochs, so datasets are not reopened on every pass over the loader.
+    One-shot test loaders release their workers when the pass is over. Batches are
+    put in pinned memory when the run device (conf.device, set by the pipeline) is a
+    GPU, so trainers can copy them with non_blocking=True.
+    """
+    split_conf = conf[split]
+    device = conf.get("device", None)
+    if device is None:
+        pin_memory = torch.cuda.is_available()
+    else:
+        pin_memory = torch.device(device).type == "cuda"
+
+    if split_conf.num_workers == 0 or not persistent:
+        return {"num_workers": split_conf.num_workers, "pin_memory": pin_memory}
+    return {
+        "num_workers": split_conf.num_workers,
+        "persistent_workers": True,
+        "prefetch_factor": split_conf.get("prefetch_factor", 4),
+        "pin_memory": pin_memory,
+    }
+
+
+class LengthBucketBatchSampler(Sampler):
+    """Batch sampler which puts sequences of similar length into one batch.
+
+    Indices are grouped by length // bucket_size and shuffled within buckets, then
+    the order of batches is shuffled. The last batch of a bucket may be smaller
+    than batch_size.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size=64, shuffle=True):
+        self.buckets = np.asarray(lengths) // bucket_size
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        if self.shuffle:
+            order = np.random.permutation(len(self.buckets))
+        else:
+            order = np.arange(len(self.buckets))
+
+        buckets = defaultdict(list)
+        for idx in order:
+            buckets[self.buckets[idx]].append(int(idx))
+
+        batches = [
+            bucket[i : i + self.batch_size]
+            for bucket in buckets.values()
+            for i in range(0, len(bucket), self.batch_size)
+        ]
+        if self.shuffle:
+            np.random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        _, counts = np.unique(self.buckets, return_counts=True)
+        return sum(math.ceil(c / self.batch_size) for c in counts)
+
+
+def padded_collate(batch, numeric_names=(), categorical_names=()):
     new_x_ = defaultdict(list)
     for x, _ in batch:
         for k, v in x.items():
@@ -164,23 +248,25 @@ def padded_collate(batch):
     new_idx = torch.tensor([y[0] for _, y in batch])
     new_y = torch.tensor([y[1] for _, y in batch])
 
-    return PaddedBatch(new_x, lengths), torch.cat(
-        [new_idx.unsqueeze(0), new_y.unsqueeze(0)], dim=0
-    )
+    return PaddedBatch.from_features(
+        new_x, lengths, numeric_names, categorical_names
+    ), torch.cat([new_idx.unsqueeze(0), new_y.unsqueeze(0)], dim=0)
 
 
-def collate_splitted_rows(batch):
+def collate_splitted_rows(batch, numeric_names=(), categorical_names=()):
     # flattens samples in list of lists to samples in list
     batch = functools.reduce(operator.iadd, batch)
-    return padded_collate(batch)
+    return padded_collate(batch, numeric_names, categorical_names)
 
 
-def collate_splitted_rows_constant(batch, max_len):
+def collate_splitted_rows_constant(
+    batch, max_len, numeric_names=(), categorical_names=()
+):
     batch = functools.reduce(operator.iadd, batch)
-    return padded_collate_constant(batch, max_len)
+    return padded_collate_constant(batch, max_len, numeric_names, categorical_names)
 
 
-def padded_collate_constant(batch, max_len):
+def padded_collate_constant(batch, max_len, numeric_names=(), categorical_names=()):
     new_x_ = defaultdict(list)
     for x, _ in batch:
         for k, v in x.items():
@@ -206,15 +292,63 @@ def padded_collate_constant(batch, max_len):
     new_idx = torch.tensor([y[0] for _, y in batch])
     new_y = torch.tensor([y[1] for _, y in batch])
 
-    return PaddedBatch(new_x, lengths), torch.cat(
-        [new_idx.unsqueeze(0), new_y.unsqueeze(0)], dim=0
-    )
+    return PaddedBatch.from_features(
+        new_x, lengths, numeric_names, categorical_names
+    ), torch.cat([new_idx.unsqueeze(0), new_y.unsqueeze(0)], dim=0)
+
+
+def _stack_payload(payload, names, dtype=None):
+    if len(names) == 0:
+        return None
+    if dtype is None:
+        dtype = functools.reduce(torch.promote_types, (payload[k].dtype for k in names))
+    return torch.stack([payload[k].to(dtype) for k in names], dim=-1)
 
 
 class PaddedBatch:
-    def __init__(self, payload: Dict[str, torch.Tensor], length: torch.LongTensor):
+    def __init__(
+        self,
+        payload: Dict[str, torch.Tensor],
+        length: torch.LongTensor,
+        numeric: Optional[torch.Tensor] = None,
+        categorical: Optional[torch.Tensor] = None,
+        numeric_names: Sequence[str] = (),
+        categorical_names: Sequence[str] = (),
+    ):
         self._payload = payload
         self._length = length
+        self._numeric = numeric
+        self._categorical = categorical
+        self._numeric_names = list(numeric_names)
+        self._categorical_names = list(categorical_names)
+
+    @classmethod
+    def from_features(cls, payload, length, numeric_names, categorical_names):
+        """Create batch with numeric and categorical features stacked.
+
+        Numeric and categorical features are stored in two contiguous B x T x N
+        tensors, their payload entries are views into these tensors. Numeric features
+        are stored as float32. Features missing from payload are skipped, other payload
+        entries (e.g. event_time) are kept as is.
+        """
+        numeric_names = [k for k in numeric_names if k in payload]
+        categorical_names = [k for k in categorical_names if k in payload]
+        batch = cls(
+            dict(payload),
+            length,
+            _stack_payload(payload, numeric_names, torch.float32),
+            _stack_payload(payload, categorical_names),
+            numeric_names,
+            categorical_names,
+        )
+        batch._set_stacked_views()
+        return batch
+
+    def _set_stacked_views(self):
+        for i, k in enumerate(self._numeric_names):
+            self._payload[k] = self._numeric[:, :, i]
+        for i, k in enumerate(self._categorical_names):
+            self._payload[k] = self._categorical[:, :, i]
 
     @property
     def payload(self):
@@ -224,16 +358,51 @@ class PaddedBatch:
     def seq_lens(self):
         return self._length
 
+    @property
+    def numeric(self):
+        """B x T x N tensor of numeric features or None if they are not stacked."""
+        return self._numeric
+
+    @property
+    def numeric_names(self):
+        return self._numeric_names
+
+    @property
+    def categorical(self):
+        """B x T x N tensor of categorical features or None if they are not stacked."""
+        return self._categorical
+
+    @property
+    def categorical_names(self):
+        return self._categorical_names
+
     def __len__(self):
         return len(self._length)
 
+    def _apply(self, fn):
+        def apply(v):
+            return None if v is None else fn(v)
+
+        # stacked features are moved once and their payload views are rebuilt,
+        # payload order is kept as processors concatenate features in this order
+        stacked = set(self._numeric_names) | set(self._categorical_names)
+        batch = PaddedBatch(
+            {k: v if k in stacked else apply(v) for k, v in self._payload.items()},
+            apply(self._length),
+            apply(self._numeric),
+            apply(self._categorical),
+            self._numeric_names,
+            self._categorical_names,
+        )
+        batch._set_stacked_views()
+        return batch
+
     def to(self, device, non_blocking=False):
-        length = self._length.to(device=device, non_blocking=non_blocking)
-        payload = {
-            k: v.to(device=device, non_blocking=non_blocking)
-            for k, v in self._payload.items()
-        }
-        return PaddedBatch(payload, length)  # type: ignore
+        return self._apply(lambda v: v.to(device=device, non_blocking=non_blocking))
+
+    def pin_memory(self):
+        """Called by DataLoader(pin_memory=True) on collated batches."""
+        return self._apply(lambda v: v.pin_memory())
 
 
 #### ALPHA DATALOADERS)
@@ -245,26 +414,21 @@ def _create_data_loaders_distributed(conf, supervised=True, pinch_test=False):
     assert conf.train.dropout == 0.0
     data = _pump_my_dataset(data, conf, "train")
 
-    if conf.use_constant_pad:
-        collate_func = functools.partial(
-            collate_splitted_rows_constant, max_len=conf.train.max_seq_len
-        )
-    else:
-        collate_func = collate_splitted_rows
+    collate_func = _make_collate_func(conf, max_len=conf.train.max_seq_len)
 
     train_loader = DataLoader(
         dataset=data,
         sampler=train_sampler,
         collate_fn=collate_func,
-        num_workers=conf.train.num_workers,
         batch_size=conf.train.batch_size,
+        **_loader_kwargs(conf, "train", persistent=True),
     )
     valid_loader = DataLoader(
         dataset=data,
         sampler=val_sampler,
         collate_fn=collate_func,
-        num_workers=conf.val.num_workers,
         batch_size=conf.val.batch_size,
+        **_loader_kwargs(conf, "val", persistent=True),
     )
     test_loader = []
     if pinch_test:
@@ -281,19 +445,14 @@ def create_test_loader_distributed(conf):
 
     test_data = _pump_my_dataset(test_data, conf, "test")
 
-    if conf.use_constant_pad:
-        collate_func = functools.partial(
-            collate_splitted_rows_constant, max_len=conf.test.max_seq_len
-        )
-    else:
-        collate_func = collate_splitted_rows
+    collate_func = _make_collate_func(conf, max_len=conf.test.max_seq_len)
 
     test_loader = DataLoader(
         dataset=test_data,
         sampler=sampler,
         collate_fn=collate_func,
-        num_workers=conf.test.num_workers,
         batch_size=conf.test.batch_size,
+        **_loader_kwargs(conf, "test"),
     )
     return test_loader
 
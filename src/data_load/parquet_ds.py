@@ -7,10 +7,11 @@ import random
 from typing import Sequence, Optional, List, Literal
 
 from torch.utils.data import Dataset, Sampler
-from fastparquet import ParquetFile
+import pyarrow.parquet as pq
 import pandas as pd
 import numpy as np
 
+from .data_utils import get_used_columns
 from .distributed_data_utils import process_record
 
 
@@ -56,12 +57,23 @@ class _GroupSampler(Sampler):
 
 
 class ParquetDataset(Dataset):
-    def __init__(self, data_path: Path, data_conf):
+    def __init__(self, data_path: Path, data_conf, columns=None):
         self._data_path = data_path.resolve()
         self.data_conf = data_conf
-        self._pf = ParquetFile(data_path.as_posix())
-
-        self._rg_lens = [rg.num_rows for rg in self._pf.row_groups]
+        # the file is opened lazily, so every dataloader worker has its own handle
+        self._pf = None
+
+        metadata = pq.read_metadata(data_path.as_posix())
+        self._columns = columns
+        if columns is not None:
+            columns = set(columns)
+            self._columns = [
+                n for n in metadata.schema.to_arrow_schema().names if n in columns
+            ]
+
+        self._rg_lens = [
+            metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)
+        ]
         _logger.debug("row group lens: %s", self._rg_lens)
         self._len = sum(self._rg_lens)
         self._rg_index = [*accumulate(self._rg_lens), 0]
@@ -116,7 +128,12 @@ class ParquetDataset(Dataset):
     def _get_rg(self, rg_idx):
         _logger.debug("Loading new parquet row group (could last for tens of seconds)")
         _logger.debug("Loading group %s", rg_idx)
-        return self._pf[rg_idx].to_pandas()
+        if self._pf is None:
+            self._pf = pq.ParquetFile(self._data_path.as_posix(), memory_map=True)
+        # dataloader workers are the parallelism here, so no extra reader threads
+        return self._pf.read_row_group(
+            rg_idx, columns=self._columns, use_threads=False
+        ).to_pandas()
 
     def __hash__(self):  # for `lru_cache` to work
         return hash(self._data_path)
@@ -133,7 +150,7 @@ class TxnParquetDataset(ParquetDataset):
         self.conf = data_conf
         data_path = Path(data_conf.test_path if test else data_conf.train_path)
 
-        super().__init__(data_path, data_conf)
+        super().__init__(data_path, data_conf, columns=get_used_columns(data_conf))
 
         self.embeddings = list(data_conf.features.embeddings.keys())
         self.feature_keys = self.embeddings + list(
@@ -142,6 +159,8 @@ class TxnParquetDataset(ParquetDataset):
 
     def __getitem__(self, idx: int):
         rec = super().__getitem__(idx)
-        rec = {k: np.asanyarray(v) for k, v in rec.to_dict().items()}
+        # list columns come from pyarrow as read-only arrays, np.array copies them
+        # so process_record can modify them in place
+        rec = {k: np.array(v) for k, v in rec.to_dict().items()}
         rec = process_record(rec, self.conf, self.feature_keys, self.embeddings)
         return rec
@@ -144,8 +144,11 @@ class GRUClassifier(BaseMixin):
 
         all_hiddens, hn = self.encoder(self.pre_encoder_norm(encoded))
         if not self.model_conf.get("time_preproc", None):
-            lens = padded_batch.seq_lens - 1
-            last_hidden = self.post_encoder_norm(all_hiddens[:, lens, :].diagonal().T)
+            idx = (padded_batch.seq_lens - 1).view(-1, 1, 1)
+            idx = idx.expand(-1, 1, all_hiddens.size(-1))
+            last_hidden = self.post_encoder_norm(
+                all_hiddens.gather(1, idx).squeeze(1)
+            )
         else:
             last_hidden = self.post_encoder_norm(hn.squeeze(0))
 
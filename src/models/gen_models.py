@@ -4,7 +4,6 @@ from . import preprocessors as prp
 from ..trainers.losses import get_loss
 import numpy as np
 import torch.nn.functional as F
-from torch.autograd import Variable
 from .model_utils import (
     out_to_padded_batch,
     FeatureMixer,
@@ -14,6 +13,7 @@ from .model_utils import (
     NumericalFeatureProjector,
 )
 from functools import partial
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from einops import repeat
 
 
@@ -23,6 +23,15 @@ class BaseMixin(nn.Module):
         self.model_conf = model_conf
         self.data_conf = data_conf
 
+        # config values read every step. ConfigDict attribute access is slow,
+        # so they are bound to plain attributes once
+        self._use_deltas = bool(self.model_conf.use_deltas)
+        self._use_log_delta = bool(self.model_conf.use_log_delta)
+        self._time_embedding = self.model_conf.time_embedding
+        self._enc_type = self.model_conf.encoder
+        self._dec_type = self.model_conf.decoder
+        self._gen_emb_loss = bool(self.model_conf.generative_embeddings_loss)
+
         ### PROCESSORS ###
         self.processor = prp.FeatureProcessor(
             model_conf=model_conf, data_conf=data_conf
@@ -60,6 +69,8 @@ class BaseMixin(nn.Module):
         self.encoder_norm = getattr(nn, self.model_conf.encoder_norm)(
             self.model_conf.encoder_hidden
         )
+        # Identity norm is skipped in forward to avoid nn.Module call overhead
+        self._pre_norm_is_identity = isinstance(self.pre_encoder_norm, nn.Identity)
 
         ### MIXER ###
         if self.model_conf.encoder_feature_mixer:
@@ -182,6 +193,15 @@ class BaseMixin(nn.Module):
             self.decoder_proj = nn.Linear(
                 self.input_dim, self.model_conf.decoder_hidden
             )
+            # causal mask for the longest decoder input (x0 + sequence), sliced in decode
+            max_dec_len = self.data_conf.test.max_seq_len + 1
+            self.register_buffer(
+                "_causal_mask",
+                torch.triu(
+                    torch.full((max_dec_len, max_dec_len), float("-inf")), diagonal=1
+                ),
+                persistent=False,
+            )
 
         ### OUT PROJECTION ###
         if self.model_conf.time_embedding:
@@ -227,9 +247,7 @@ class BaseMixin(nn.Module):
         cross_entropy_losses = self.embedding_predictor.loss(
             output["pred"], output["gt"]["input_batch"]
         )
-        total_ce_loss = torch.sum(
-            torch.cat([value.unsqueeze(0) for _, value in cross_entropy_losses.items()])
-        )
+        total_ce_loss = torch.stack(list(cross_entropy_losses.values())).sum()
 
         ### SPARCE EMBEDDINGS ###
         sparce_loss = torch.mean(torch.sum(torch.abs(output["latent"]), dim=1))
@@ -259,29 +277,36 @@ class BaseMixin(nn.Module):
 
     def numerical_loss(self, output):
         # MSE
-        total_mse_loss = torch.tensor(0.0, device=self.model_conf.device)
-        for key, values in output["gt"]["input_batch"].payload.items():
-            if key in self.processor.numeric_names:
-                gt_val = values.float()
-                pred_val = output["pred"][key].squeeze(-1)
-
-                mse_loss = self.mse_fn(
-                    gt_val,
-                    pred_val,
-                )
-                mask = gt_val != 0
-                masked_mse = mse_loss * mask
-                total_mse_loss += (
-                    masked_mse.sum(dim=1) # / (mask != 0).sum(dim=1)
-                ).mean()
+        numeric_names = self.processor.numeric_names
+        if len(numeric_names) == 0:
+            return torch.tensor(0.0, device=self.model_conf.device)
+
+        input_batch = output["gt"]["input_batch"]
+        if input_batch.numeric_names == numeric_names:
+            gt_val = input_batch.numeric.float()
+        else:
+            payload = input_batch.payload
+            gt_val = torch.stack(
+                [payload[key].float() for key in numeric_names], dim=-1
+            )
+        pred_val = torch.stack(
+            [output["pred"][key].squeeze(-1) for key in numeric_names], dim=-1
+        )  # B x T x N
+
+        mse_loss = self.mse_fn(gt_val, pred_val)
+        mask = gt_val != 0
+        masked_mse = mse_loss * mask
+        # sum over time and features, mean over batch. The same as summing per feature
+        # losses, each averaged over batch
+        total_mse_loss = masked_mse.sum(dim=(1, 2)).mean()  # / (mask != 0).sum(dim=1)
 
         return total_mse_loss
 
     def delta_mse_loss(self, output):
         # DELTA MSE
-        if self.model_conf.use_deltas:
-            gt_delta = output["gt"]["time_steps"].diff(1)
-            if self.model_conf.use_log_delta:
+        if self._use_deltas:
+            gt_delta = output["gt"]["gt_delta"]
+            if self._use_log_delta:
                 gt_delta = torch.log(gt_delta + 1e-15)
             delta_mse = self.mse_fn(gt_delta, output["pred"]["delta"][:, :-1])
             # print(delta_mse, gt_delta[0], output["gt"]["time_steps"].diff(1)[0], output["gt"]["time_steps"][0])
@@ -295,7 +320,7 @@ class BaseMixin(nn.Module):
         return delta_mse
 
     def generative_embedding_loss(self, output):
-        if self.model_conf.generative_embeddings_loss:
+        if self._gen_emb_loss:
             gt = output["all_latents"].detach()
             gen = output["gen_all_latents"]
             # у кого рубить градиент?))))
@@ -332,16 +357,16 @@ class BaseMixin(nn.Module):
             out = out.unsqueeze(1)
 
         # if we use deltas then we need to mix features without them
-        if self.model_conf.use_deltas:
+        if self._use_deltas:
             out_mixed = self.decoder_feature_mixer(out[:, :, :-1])
 
             delta = out[:, :, -1]
-            if generation and self.model_conf.use_log_delta:
+            if generation and self._use_log_delta:
                 delta = torch.exp(delta)
             # if we use time embedding, we expect input as time_embedding
             # but this should happen only during generation
             if generation:
-                if self.model_conf.time_embedding:
+                if self._time_embedding:
                     prev_input = torch.cat(
                         [out_mixed, self.time_encoder.create_emb(delta)], dim=-1
                     )
@@ -357,7 +382,7 @@ class BaseMixin(nn.Module):
             out = out.squeeze(1)
 
         if generation:
-            if self.model_conf.decoder == "TR":
+            if self._dec_type == "TR":
                 prev_input = self.decoder_proj(self.act(prev_input))
 
             if len(dec_out.size()) == 2:  # used when generated in rnn
@@ -385,9 +410,15 @@ class SeqGen(BaseMixin):
 
     def forward(self, padded_batch):
         all_hidden, global_hidden, time_steps = self.encode(padded_batch)
-        pred = self.decode(padded_batch, global_hidden)
-
-        gt = {"input_batch": padded_batch, "time_steps": time_steps}
+        # shared by the decoder time features and the delta loss
+        gt_delta = time_steps.diff(1)
+        pred = self.decode(padded_batch, global_hidden, gt_delta)
+
+        gt = {
+            "input_batch": padded_batch,
+            "time_steps": time_steps,
+            "gt_delta": gt_delta,
+        }
 
         res_dict = {
             "gt": gt,
@@ -395,7 +426,7 @@ class SeqGen(BaseMixin):
             "latent": global_hidden,
         }
 
-        if self.model_conf.generative_embeddings_loss:
+        if self._gen_emb_loss:
             res_dict["all_latents"] = all_hidden
             gen_batch = out_to_padded_batch(res_dict, self.data_conf)
             set_grad(self.encoder_layers, False)
@@ -411,7 +442,7 @@ class SeqGen(BaseMixin):
     def encode(self, padded_batch):
         x, time_steps = self.processor(padded_batch)
 
-        if self.model_conf.time_embedding:
+        if self._time_embedding:
             x = self.time_encoder(x, time_steps)
             x = self.encoder_feature_mixer(x)
         else:
@@ -420,11 +451,21 @@ class SeqGen(BaseMixin):
 
         x = self.preENC_TR(x)
 
-        if self.model_conf.encoder in ("GRU", "LSTM"):
-            all_hid, hn = self.encoder(self.pre_encoder_norm(x))
-            lens = padded_batch.seq_lens - 1
-            global_hidden = self.post_encoder_norm(all_hid[:, lens, :].diagonal().T)
-        elif self.model_conf.encoder == "TR":
+        if self._enc_type in ("GRU", "LSTM"):
+            if not self._pre_norm_is_identity:
+                x = self.pre_encoder_norm(x)
+            # padded steps are skipped, hn holds the hidden at the last real step
+            packed = pack_padded_sequence(
+                x, padded_batch.seq_lens.cpu(), batch_first=True, enforce_sorted=False
+            )
+            all_hid, hn = self.encoder(packed)
+            all_hid, _ = pad_packed_sequence(
+                all_hid, batch_first=True, total_length=x.size(1)
+            )
+            if self._enc_type == "LSTM":
+                hn = hn[0]
+            global_hidden = self.post_encoder_norm(hn[-1])
+        elif self._enc_type == "TR":
             x_proj = self.encoder_proj(x)
             # x_proj = x
             x_proj = torch.cat(
@@ -441,20 +482,18 @@ class SeqGen(BaseMixin):
 
         return all_hid, global_hidden, time_steps
 
-    def decode(self, padded_batch, global_hidden):
+    def decode(self, padded_batch, global_hidden, gt_delta=None):
         x, time_steps = self.processor(padded_batch, use_norm=False)
-        x = self.time_encoder(x, time_steps)
+        x = self.time_encoder(x, time_steps, gt_delta)
 
         x0 = self.hidden_to_x0(global_hidden)
         x = torch.cat([x0.unsqueeze(1), x], dim=1)
-        if self.model_conf.decoder == "GRU":
+        if self._dec_type == "GRU":
             dec_out = self.decoder(x, global_hidden)
 
-        elif self.model_conf.decoder == "TR":
+        elif self._dec_type == "TR":
             x_proj = self.decoder_proj(self.act(x))
-            mask = torch.nn.Transformer.generate_square_subsequent_mask(
-                x.size(1), device=x.device
-            )
+            mask = self._causal_mask[: x.size(1), : x.size(1)]
             x_proj = x_proj + self.dec_pos_encoding(
                 torch.arange(x_proj.size(1), device=self.model_conf.device)
             )
@@ -472,14 +511,14 @@ class SeqGen(BaseMixin):
 
         pred = self.embedding_predictor(out)
         pred.update(self.numeric_projector(out))
-        if self.model_conf.use_deltas:
+        if self._use_deltas:
             pred["delta"] = torch.abs(out[:, :, -1].squeeze(-1))
 
         return pred
 
     def generate_sequence(self, global_hidden, lens):
         x0 = self.hidden_to_x0(global_hidden)
-        if self.model_conf.decoder == "TR":
+        if self._dec_type == "TR":
             global_hidden = self.decoder_proj(self.act(x0))
             x0 = global_hidden
 
@@ -491,7 +530,7 @@ class SeqGen(BaseMixin):
         )
         pred = self.embedding_predictor(gens)
         pred.update(self.numeric_projector(gens))
-        if self.model_conf.use_deltas:
+        if self._use_deltas:
             pred["delta"] = torch.abs(gens[:, :, -1].squeeze(-1))
 
         return pred
@@ -518,9 +557,7 @@ class GenContrastive(SeqGen):
         cross_entropy_losses = self.embedding_predictor.loss(
             output["pred"], output["gt"]["input_batch"]
         )
-        total_ce_loss = torch.sum(
-            torch.cat([value.unsqueeze(0) for _, value in cross_entropy_losses.items()])
-        )
+        total_ce_loss = torch.stack(list(cross_entropy_losses.values())).sum()
 
         ### SPARCE EMBEDDINGS ###
         sparce_loss = torch.mean(torch.sum(torch.abs(output["latent"]), dim=1))
@@ -570,6 +607,20 @@ class GenSigmoid(SeqGen):
         self.sigmoid_bias = nn.Parameter(init_bias)
 
 
+@torch.jit.script
+def _gru_gates(x_t: torch.Tensor, h_t: torch.Tensor, hx: torch.Tensor):
+    # pointwise part of the GRU cell, scripted so that the fuser merges it
+    # into a single kernel instead of launching one per op
+    x_reset, x_upd, x_new = x_t.chunk(3, 1)
+    h_reset, h_upd, h_new = h_t.chunk(3, 1)
+
+    reset_gate = torch.sigmoid(x_reset + h_reset)
+    update_gate = torch.sigmoid(x_upd + h_upd)
+    new_gate = torch.tanh(x_new + (reset_gate * h_new))
+
+    return update_gate * hx + (1 - update_gate) * new_gate
+
+
 class GRUCell(nn.Module):
     def __init__(self, input_size, hidden_size, global_hidden_size, bias=True):
         super(GRUCell, self).__init__()
@@ -579,7 +630,10 @@ class GRUCell(nn.Module):
 
         self.x2h = nn.Linear(input_size, 3 * hidden_size, bias=bias)
         self.h2h = nn.Linear(hidden_size, 3 * hidden_size, bias=bias)
-        self.mix_global = nn.Linear(hidden_size + global_hidden_size, hidden_size)
+        # mixing of the global hidden into the state, Linear(cat([global, hx]))
+        # split in two parts: the global one does not change over time
+        self.mg_g = nn.Linear(global_hidden_size, hidden_size, bias=False)
+        self.mg_h = nn.Linear(hidden_size, hidden_size)
         self.act = nn.GELU()
         self.reset_parameters()
 
@@ -588,6 +642,18 @@ class GRUCell(nn.Module):
         for w in self.parameters():
             w.data.uniform_(-std, std)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the split keep a single mix_global layer
+        weight = state_dict.pop(prefix + "mix_global.weight", None)
+        if weight is not None:
+            g_size = weight.size(1) - self.hidden_size
+            state_dict[prefix + "mg_g.weight"] = weight[:, :g_size]
+            state_dict[prefix + "mg_h.weight"] = weight[:, g_size:]
+            state_dict[prefix + "mg_h.bias"] = state_dict.pop(
+                prefix + "mix_global.bias"
+            )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, input, global_hidden, hx=None):
         # Inputs:
         #       input: of shape (batch_size, input_size)
@@ -595,25 +661,25 @@ class GRUCell(nn.Module):
         #       hx: of shape (batch_size, hidden_size)
         # Output:
         #       hy: of shape (batch_size, hidden_size)
+        return self.step(self.x2h(input), self.mg_g(global_hidden), hx)
+
+    def step(self, x_t, g, hx=None):
+        # Recurrent part of the cell, input and global projections are done
+        # by the caller so that they are computed once for the whole sequence.
+        # Inputs:
+        #       x_t: of shape (batch_size, 3 * hidden_size), equals self.x2h(input)
+        #       g: of shape (batch_size, hidden_size), equals self.mg_g(global_hidden)
+        #       hx: of shape (batch_size, hidden_size)
+        # Output:
+        #       hy: of shape (batch_size, hidden_size)
 
         if hx is None:
-            hx = Variable(input.new_zeros(input.size(0), self.hidden_size))
+            hx = x_t.new_zeros(x_t.size(0), self.hidden_size)
 
-        hx = hx
-        hx = self.act(self.mix_global(torch.cat([global_hidden, hx], dim=-1)))
-        x_t = self.x2h(input)
+        hx = self.act(self.mg_h(hx) + g)
         h_t = self.h2h(hx)
 
-        x_reset, x_upd, x_new = x_t.chunk(3, 1)
-        h_reset, h_upd, h_new = h_t.chunk(3, 1)
-
-        reset_gate = torch.sigmoid(x_reset + h_reset)
-        update_gate = torch.sigmoid(x_upd + h_upd)
-        new_gate = torch.tanh(x_new + (reset_gate * h_new))
-
-        hy = update_gate * hx + (1 - update_gate) * new_gate
-
-        return hy
+        return _gru_gates(x_t, h_t, hx)
 
 
 class DecoderGRU(nn.Module):
@@ -650,42 +716,32 @@ class DecoderGRU(nn.Module):
         # Output of shape (batch_size, output_size)
 
         if hx is None:
-            h0 = Variable(
-                torch.zeros(self.num_layers, input.size(0), self.hidden_size).to(
-                    input.device
-                )
-            )
+            h0 = input.new_zeros(self.num_layers, input.size(0), self.hidden_size)
 
         else:
             h0 = hx
 
-        outs = []
-
-        hidden = list()
-        for layer in range(self.num_layers):
-            hidden.append(h0[layer, :, :])
+        # Layer l at step t depends only on layer l at step t - 1 and layer l - 1
+        # at step t, so the layers are unrolled one after another. This way the
+        # input projection of every layer is a single matmul over the whole sequence.
+        layer_input = input
+        for layer, cell in enumerate(self.rnn_cell_list):
+            x_proj = cell.x2h(layer_input)
+            g = cell.mg_g(global_hidden)
 
-        for t in range(input.size(1)):
-            for layer in range(self.num_layers):
-                if layer == 0:
-                    hidden_l = self.rnn_cell_list[layer](
-                        input[:, t, :], global_hidden, hidden[layer]
-                    )
-                else:
-                    hidden_l = self.rnn_cell_list[layer](
-                        hidden[layer - 1], global_hidden, hidden[layer]
-                    )
-                hidden[layer] = hidden_l
+            hidden_l = h0[layer, :, :]
+            outs = []
+            for t in range(x_proj.size(1)):
+                hidden_l = cell.step(x_proj[:, t, :], g, hidden_l)
+                outs.append(hidden_l)
 
-            outs.append(hidden_l.unsqueeze(1))
+            layer_input = torch.stack(outs, dim=1)
 
-        return torch.cat(outs, dim=1)
+        return layer_input
 
     def generate(self, global_hidden, length, pred_layers, first_step=None):
-        h0 = Variable(
-            torch.zeros(self.num_layers, global_hidden.size(0), self.hidden_size).to(
-                global_hidden.device
-            )
+        h0 = global_hidden.new_zeros(
+            self.num_layers, global_hidden.size(0), self.hidden_size
         )
 
         if first_step is None:
@@ -699,16 +755,16 @@ class DecoderGRU(nn.Module):
         for layer in range(self.num_layers):
             hidden.append(h0[layer, :, :])
 
+        gs = [cell.mg_g(global_hidden) for cell in self.rnn_cell_list]
+
         prev_input = first_step
         for t in range(length):
-            for layer in range(self.num_layers):
+            for layer, cell in enumerate(self.rnn_cell_list):
                 if layer == 0:
-                    hidden_l = self.rnn_cell_list[layer](
-                        prev_input, global_hidden, hidden[layer]
-                    )
+                    hidden_l = cell.step(cell.x2h(prev_input), gs[layer], hidden[layer])
                 else:
-                    hidden_l = self.rnn_cell_list[layer](
-                        hidden[layer - 1], global_hidden, hidden[layer]
+                    hidden_l = cell.step(
+                        cell.x2h(hidden[layer - 1]), gs[layer], hidden[layer]
                     )
 
                 hidden[layer] = hidden_l
@@ -21,16 +21,81 @@ class EmbeddingPredictor(nn.Module):
         self.num_embeds = len(self.emb_names)
         self.categorical_len = self.num_embeds * self.model_conf.features_emb_dim
 
+        # int8 copies of predictors used for inference on cpu. Kept in a plain dict
+        # so they are not registered as submodules and do not get to state_dict
+        self.quantize = self.model_conf.get("quantize_predictors", False)
+        self._quantized_cache = {}
+
         self.init_embed_predictors()
 
     def init_embed_predictors(self):
-        self.embed_predictors = nn.ModuleDict()
+        # all predictors are stored in one padded weight so that the logits for every
+        # feature are computed with a single matmul
+        emb_dim = self.model_conf.features_emb_dim
+        self.vocab_sizes = [
+            self.data_conf.features.embeddings[name]["max_value"]
+            for name in self.emb_names
+        ]
+        max_vocab = max(self.vocab_sizes, default=0)
+
+        self.W = nn.Parameter(torch.zeros(self.num_embeds, emb_dim, max_vocab))
+        self.b = nn.Parameter(torch.zeros(self.num_embeds, max_vocab))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # the same init as nn.Linear, padded part of the weights is left zero
+        bound = 1 / math.sqrt(self.model_conf.features_emb_dim)
+        with torch.no_grad():
+            for i, vocab_size in enumerate(self.vocab_sizes):
+                weight = torch.empty(vocab_size, self.model_conf.features_emb_dim)
+                nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
+                self.W[i, :, :vocab_size] = weight.T
+                self.b[i, :vocab_size].uniform_(-bound, bound)
+
+    def train(self, mode=True):
+        # weights are going to change or were changed, quantized copies are stale
+        self._quantized_cache.clear()
+        return super().train(mode)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        self._quantized_cache.clear()
+        # checkpoints saved before the weights were merged keep a Linear per feature
+        old_prefix = prefix + "embed_predictors."
+        if any(k.startswith(old_prefix) for k in state_dict):
+            W = self.W.detach().clone()
+            b = self.b.detach().clone()
+            for i, (name, vocab_size) in enumerate(
+                zip(self.emb_names, self.vocab_sizes)
+            ):
+                weight = state_dict.pop(old_prefix + name + ".weight", None)
+                bias = state_dict.pop(old_prefix + name + ".bias", None)
+                if weight is not None:
+                    W[i, :, :vocab_size] = weight.T
+                if bias is not None:
+                    b[i, :vocab_size] = bias
+            state_dict[prefix + "W"] = W
+            state_dict[prefix + "b"] = b
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def quantized_predictors(self):
+        if "predictors" not in self._quantized_cache:
+            predictors = nn.ModuleDict()
+            for i, (name, vocab_size) in enumerate(
+                zip(self.emb_names, self.vocab_sizes)
+            ):
+                linear = nn.Linear(self.model_conf.features_emb_dim, vocab_size)
+                linear.weight.data = (
+                    self.W[i, :, :vocab_size].detach().T.contiguous().cpu()
+                )
+                linear.bias.data = self.b[i, :vocab_size].detach().cpu()
+                predictors[name] = linear
 
-        for name in self.emb_names:
-            vocab_size = self.data_conf.features.embeddings[name]["max_value"]
-            self.embed_predictors[name] = nn.Linear(
-                self.model_conf.features_emb_dim, vocab_size
+            self._quantized_cache["predictors"] = (
+                torch.ao.quantization.quantize_dynamic(
+                    predictors, {nn.Linear}, dtype=torch.qint8
+                )
             )
+        return self._quantized_cache["predictors"]
 
     def forward(self, x_recon):
         batch_size, seq_len, out_dim = x_recon.size()
@@ -40,19 +105,38 @@ class EmbeddingPredictor(nn.Module):
             self.num_embeds,
             self.model_conf.features_emb_dim,
         )
+        if self.quantize and not self.training and x_recon.device.type == "cpu":
+            predictors = self.quantized_predictors()
+            return {
+                name: predictors[name](resized_x[:, :, i, :])
+                for i, name in enumerate(self.emb_names)
+            }
+
+        logits = torch.einsum("btne,nev->btnv", resized_x, self.W) + self.b
+
         embeddings_distribution = {}
-        for i, name in enumerate(self.emb_names):
-            embeddings_distribution[name] = self.embed_predictors[name](
-                resized_x[:, :, i, :]
-            )
+        for i, (name, vocab_size) in enumerate(zip(self.emb_names, self.vocab_sizes)):
+            embeddings_distribution[name] = logits[:, :, i, :vocab_size]
 
         return embeddings_distribution
 
     def loss(self, embedding_distribution, padded_batch):
         embed_losses = {}
-        for name, dist in embedding_distribution.items():
-            if name in self.emb_names:
-                shifted_labels = padded_batch.payload[name].long()  # [:, 1:]
+        if (
+            padded_batch.categorical is not None
+            and padded_batch.categorical_names == self.emb_names
+        ):
+            all_labels = padded_batch.categorical.long()
+        else:
+            all_labels = None
+
+        for i, name in enumerate(self.emb_names):
+            if name in embedding_distribution:
+                dist = embedding_distribution[name]
+                if all_labels is not None:
+                    shifted_labels = all_labels[:, :, i]
+                else:
+                    shifted_labels = padded_batch.payload[name].long()  # [:, 1:]
                 embed_losses[name] = (
                     self.criterion(dist.permute(0, 2, 1), shifted_labels)
                     .sum(dim=1) # changed to mean
@@ -34,7 +34,8 @@ class RBatchNormWithLens(torch.nn.Module):
         mask = (
             torch.arange(T, device=seq_lens.device).view(1, -1).repeat(B, 1)
         ) < seq_lens.view(-1, 1)
-        x_new = x
+        # out of place: x may be a view into the batch, which is used as ground truth
+        x_new = x.clone()
         x_new[mask] = self.bn(x[mask].view(-1, 1)).view(-1)
         return x_new.view(B, T, 1)
 
@@ -47,6 +48,9 @@ class FeatureProcessor(nn.Module):
 
         self.emb_names = list(self.data_conf.features.embeddings.keys())
         self.numeric_names = list(self.data_conf.features.numeric_values.keys())
+        # sets for O(1) membership checks in forward
+        self.emb_name_set = frozenset(self.emb_names)
+        self.numeric_name_set = frozenset(self.numeric_names)
         self.init_embed_layers()
 
     def init_embed_layers(self):
@@ -77,9 +81,9 @@ class FeatureProcessor(nn.Module):
         time_steps = padded_batch.payload.get("event_time").float()
         seq_lens = padded_batch.seq_lens
         for key, values in padded_batch.payload.items():
-            if key in self.emb_names:
+            if key in self.emb_name_set:
                 categoric_values.append(self.embed_layers[key](values.long()))
-            elif key in self.numeric_names:
+            elif key in self.numeric_name_set:
                 if use_norm:
                     cur_value = self.numeric_norms[key](values.float(), seq_lens)
                 else:  # we do not want to use normalization when applying decoder to our sequence
@@ -222,13 +226,17 @@ class TimeEncoder(nn.Module):
         if self.model_conf.time_embedding and self.model_conf.use_deltas:
             self.alpha = nn.Parameter(torch.rand(self.model_conf.time_embedding))
 
-    def forward(self, x, time_steps):
+        # zero delta for the first event, expanded to batch size in forward
+        self.register_buffer("_delta_pad", torch.zeros(1, 1), persistent=False)
+
+    def forward(self, x, time_steps, gt_delta=None):
         if not self.model_conf.use_deltas:
             return x
 
-        gt_delta = time_steps.diff(1)
+        if gt_delta is None:
+            gt_delta = time_steps.diff(1)
         delta_feature = torch.cat(
-            [torch.zeros(x.size(0), 1, device=gt_delta.device), gt_delta], dim=1
+            [self._delta_pad.expand(x.size(0), 1), gt_delta], dim=1
         )
         time_emb = self.create_emb(delta_feature)
 
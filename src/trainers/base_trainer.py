@@ -1,5 +1,6 @@
 import logging
 import os
+from contextlib import nullcontext
 from datetime import datetime
 from pathlib import Path
 from typing import Any, Dict, List, Literal, Union, Tuple
@@ -46,6 +47,17 @@ class _CyclicalLoader:
         return item
 
 
+def _to_float32(output):
+    """Cast floating point tensors of a (nested) model output to float32."""
+    if isinstance(output, torch.Tensor):
+        return output.float() if output.is_floating_point() else output
+    if isinstance(output, dict):
+        return {k: _to_float32(v) for k, v in output.items()}
+    if isinstance(output, (list, tuple)):
+        return type(output)(_to_float32(v) for v in output)
+    return output
+
+
 def _grad_norm(named_parameters):
     total_sq_norm = 0.0
     for n, p in named_parameters:
@@ -80,6 +92,7 @@ class BaseTrainer:
         metrics_on_train: bool = False,
         model_conf: Dict[str, Any] = None,
         data_conf: Dict[str, Any] = None,
+        amp_dtype: Union[str, None] = None,
     ):
         """Initialize trainer.
 
@@ -106,6 +119,9 @@ class BaseTrainer:
             metrics_on_train: wether to compute metrics on train set.
             model_conf: Model configs from configs/ dir
             data_conf: Data configs from configs/ dir
+            amp_dtype: if set ("bfloat16" or "float16"), model forward is run under
+                `torch.autocast` with this dtype. Loss is computed in full precision.
+                Gradients are scaled with `GradScaler` for "float16".
         """
         assert (total_iters is None) ^ (
             total_epochs is None
@@ -126,6 +142,11 @@ class BaseTrainer:
         self._metrics_on_train = metrics_on_train
         self._model_conf = model_conf
         self._data_conf = data_conf
+        self._amp_dtype = getattr(torch, amp_dtype) if amp_dtype else None
+        self._grad_scaler = torch.amp.GradScaler(
+            "cuda",
+            enabled=self._amp_dtype == torch.float16
+        )
 
         self._model = model
         self._model.to(device)
@@ -169,6 +190,25 @@ class BaseTrainer:
     def device(self) -> str:
         return self._device
 
+    def _autocast(self):
+        if self._amp_dtype is None:
+            return nullcontext()
+        return torch.autocast(
+            device_type=torch.device(self._device).type, dtype=self._amp_dtype
+        )
+
+    def _forward(self, inp):
+        """Run the model, under autocast if `amp_dtype` is set.
+
+        Outputs are cast back to float32, so losses and metrics are computed in full
+        precision.
+        """
+        if self._amp_dtype is None:
+            return self._model(inp)
+        with self._autocast():
+            out = self._model(inp)
+        return _to_float32(out)
+
     def _make_key_extractor(self, key):
         def key_extractor(p: Path) -> float:
             metrics = {}
@@ -299,15 +339,16 @@ class BaseTrainer:
         pbar = tqdm(zip(range(iters), self._cyc_train_loader), total=iters)
         pbar.set_description_str(f"Epoch {self._last_epoch + 1: 3}")
         for i, (inp, gt) in pbar:
-            inp, gt = inp.to(self._device), gt.to(self._device)
+            inp = inp.to(self._device, non_blocking=True)
+            gt = gt.to(self._device, non_blocking=True)
 
-            pred = self._model(inp)
+            pred = self._forward(inp)
             if self._metrics_on_train:
                 preds.append(pred.to("cpu"))
                 gts.append(gt.to("cpu"))
 
             loss = self.compute_loss(pred, gt)
-            loss.backward()
+            self._grad_scaler.scale(loss).backward()
 
             loss_np = loss.item()
             losses.append(loss_np)
@@ -316,7 +357,8 @@ class BaseTrainer:
 
             # CLIP GRADIENTS
             # torch.nn.utils.clip_grad_norm_(self._model.parameters(), 5)
-            self._opt.step()
+            self._grad_scaler.step(self._opt)
+            self._grad_scaler.update()
 
             self._last_iter += 1
             logger.debug(
@@ -368,8 +410,8 @@ class BaseTrainer:
         with torch.no_grad():
             for inp, gt in tqdm(loader):
                 gts.append(gt.to("cpu"))
-                inp = inp.to(self._device)
-                pred = self._model(inp)
+                inp = inp.to(self._device, non_blocking=True)
+                pred = self._forward(inp)
                 preds.append(pred.to("cpu"))
                 i += loader.batch_size
                 if limit and i > limit:
@@ -295,7 +295,7 @@ class GenTrainer(BaseTrainer):
             for inp, gt in tqdm(loader):
                 gts.append(gt.to(self._device))
                 inp = inp.to(self._device)
-                out = self._model(inp)
+                out = self._forward(inp)
                 out = self.dict_to_cpu(out)
                 preds.append(out["latent"])
                 counter += loader.batch_size
@@ -313,7 +313,7 @@ class GenTrainer(BaseTrainer):
             for inp, gt in tqdm(loader):
                 gts.append(gt.to(self._device))
                 inp = inp.to(self._device)
-                out = self._model(inp)
+                out = self._forward(inp)
                 out = self.dict_to_cpu(out)
                 out["gt"].pop("input_batch")
                 out.pop("all_latents", None)
@@ -332,7 +332,7 @@ class GenTrainer(BaseTrainer):
         with torch.no_grad():
             for inp, gt in tqdm(self._val_loader):
                 inp = inp.to(self._device)
-                model_output = self._model(inp)
+                model_output = self._forward(inp)
                 loss_dicts.append(self._model.loss(model_output, gt))
 
         self._metric_values = {